@@ -3,7 +3,13 @@ Neural Net logic.
 """
 
 # System Imports.
-import datetime, json, keras, numpy
+import datetime, json, keras, numpy, tensorflow
+
+# Optional streaming JSON parser. Falls back to standard json module if not installed.
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 # User Class Imports.
 from resources import logging
@@ -21,16 +27,25 @@ class RecurrentNet():
         logger.info('Starting Recurrent Net.')
 
         self.model = None
+        self.sampler = None
         self.data = None
 
         self.unique_char_set = None
+        self.unique_char_count = 0
         self.max_string_length = 0
         self.char_to_int_dict = {}
         self.int_to_char_dict = {}
+        self.int_to_char_array = None
+        self.char_lookup_table = None
+        self.onehot_lookup = None
+
+        self.feature_ids = None
+        self.targets = None
 
         self.import_data(data_source)
         self.get_character_set()
         self.build_architecture()
+        self.prepare_tensors()
 
     def __del__(self):
         logger.info('Recurrent Net finished.')
@@ -54,105 +69,173 @@ class RecurrentNet():
             exit(1)
 
         try:
-            file = open(file_location, 'r')
-
-            dataset_import = json.load(file)
-            dataset = []
-
-            # Find length of longest individual record in dataset. Use as length for all records.
-            # Note that all characters start with escape code '\1'. All characters are end-padded with escape code '\0'.
-            for line in dataset_import:
-                new_record = len(line['text'])
-                if new_record > self.max_string_length:
-                    self.max_string_length = new_record
-            self.max_string_length += 3
+            with open(file_location, 'rb') as file:
+                # If available, stream records so the full JSON array is never held in memory.
+                if ijson is not None:
+                    dataset_import = ijson.items(file, 'item')
+                else:
+                    dataset_import = json.load(file)
+
+                # For each record in dataset, wrap in escape codes.
+                # Note that all records start with escape code '\1' and end with escape code '\2'.
+                # All records are then end-padded with escape code '\0'.
+                # Length of longest individual record is tracked in same pass. Used as length for all records.
+                dataset = []
+                max_text_length = 0
+                for line in dataset_import:
+                    text = line['text']
+                    if len(text) > max_text_length:
+                        max_text_length = len(text)
+                    dataset.append('\1' + text + '\2' + '\0')
+
+            self.max_string_length = max_text_length + 3
             logger.info('Max record length: {0}'.format(self.max_string_length))
 
-            # For each record in dataset, append until
-            for line in dataset_import:
-                new_record = '\1'
-                new_record += line['text']
-                new_record += '\2'
-                new_record += '\0'
-                dataset.append(new_record)
-
-            file.close()
-
             # logger.info(dataset)
             self.data = dataset
 
-        except Exception:
+        except Exception as err:
             logger.error('Error reading file.')
-            logger.error(Exception, exc_info=True)
-
+            logger.error(err, exc_info=True)
 
     def build_architecture(self):
         """
         Build neural net layout.
         """
+        char_count = self.unique_char_count
+
+        # Use mixed precision when a GPU is available. On CPU, float16 math is slower rather than faster.
+        optimizer = 'adam'
+        if tensorflow.config.list_physical_devices('GPU'):
+            keras.mixed_precision.set_global_policy('mixed_float16')
+            optimizer = keras.mixed_precision.LossScaleOptimizer(keras.optimizers.Adam())
+        logger.info('Precision Policy: {0}'.format(keras.mixed_precision.global_policy().name))
+
         self.model = keras.models.Sequential()
 
         # LSTM layers for recurrent steps.
         # Note: Masking (supposedly) hides null terminating pad character from weights.
         self.model.add(keras.layers.Masking(
             mask_value=self.char_to_int_dict['\0'],
-            input_shape=(self.max_string_length, len(self.unique_char_set))
-        ))
-        self.model.add(keras.layers.LSTM(
-            len(self.unique_char_set),
-            input_shape=(self.max_string_length, len(self.unique_char_set)),
-            return_sequences=True,
-            kernel_initializer="one",
-        ))
-        self.model.add(keras.layers.Dropout(0.2))
-        self.model.add(keras.layers.LSTM(
-            len(self.unique_char_set),
-            return_sequences=True,
-        ))
-        self.model.add(keras.layers.Dropout(0.2))
-        self.model.add(keras.layers.LSTM(
-            len(self.unique_char_set),
-            return_sequences=True,
+            input_shape=(self.max_string_length, char_count)
         ))
-        self.model.add(keras.layers.Dropout(0.2))
-        self.model.add(keras.layers.LSTM(
-            len(self.unique_char_set),
-            return_sequences=True,
-        ))
-        self.model.add(keras.layers.Dropout(0.2))
+        # Note: Arguments are kept at the values required for Keras to dispatch to the fused cuDNN kernel.
+        # Input dropout is applied within each LSTM, which (unlike recurrent dropout) keeps cuDNN eligibility.
+        for layer_index in range(4):
+            self.model.add(keras.layers.LSTM(
+                char_count,
+                activation='tanh',
+                recurrent_activation='sigmoid',
+                dropout=0.2,
+                recurrent_dropout=0,
+                unroll=False,
+                use_bias=True,
+                return_sequences=True,
+            ))
 
         # Dense and activation layers for recurrent steps.
-        self.model.add(keras.layers.TimeDistributed(keras.layers.Dense(len(self.unique_char_set))))
-        self.model.add(keras.layers.Activation('softmax'))
-        self.model.compile(loss='categorical_crossentropy', optimizer='adam', metrics=['accuracy'])
+        # Note: Softmax output is kept at float32 for numerical stability under mixed precision.
+        self.model.add(keras.layers.TimeDistributed(keras.layers.Dense(char_count)))
+        self.model.add(keras.layers.Activation('softmax', dtype='float32'))
+        # Note: fit/predict already trace their steps into graph functions by default.
+        # run_eagerly=False only pins that existing default explicitly.
+        self.model.compile(
+            loss='sparse_categorical_crossentropy',
+            optimizer=optimizer,
+            metrics=['accuracy'],
+            run_eagerly=False,
+        )
 
         self.model.summary()
+        for layer in self.model.layers:
+            if isinstance(layer, keras.layers.LSTM):
+                logger.info('{0} cuDNN Eligible: {1}'.format(layer.name, getattr(layer, '_could_use_gpu_kernel', None)))
+
+        self.build_sampler()
+
+    def build_sampler(self):
+        """
+        Build stateful, single-step copy of neural net layout, for text generation.
+
+        Mirrors the weighted layers of the main model, so weights can be copied across directly.
+        Carries LSTM state between calls, so each character only needs to be processed once.
+        """
+        char_count = self.unique_char_count
+        self.sampler = keras.models.Sequential()
+        self.sampler.add(keras.layers.InputLayer(
+            input_shape=(1, char_count),
+            batch_size=1,
+        ))
+
+        for layer_index in range(4):
+            self.sampler.add(keras.layers.LSTM(
+                char_count,
+                activation='tanh',
+                recurrent_activation='sigmoid',
+                recurrent_dropout=0,
+                unroll=False,
+                use_bias=True,
+                return_sequences=True,
+                stateful=True,
+            ))
+
+        self.sampler.add(keras.layers.TimeDistributed(keras.layers.Dense(char_count)))
+        self.sampler.add(keras.layers.Activation('softmax', dtype='float32'))
+
+    @tensorflow.function
+    def sample_step(self, step_input):
+        """
+        Runs sampler on a single character, as a compiled graph function.
+        Avoids the per-call overhead of predict(), which is built for large batches rather than single steps.
+        :param step_input: Onehot of single character to feed in.
+        :return: Predicted probabilities of next character.
+        """
+        return self.sampler(step_input, training=False)
 
     def get_character_set(self):
         """
         Creates dictionary of all unique characters in dataset. Also creates reverse translation dict.
         """
         # Create sorted list of all unique characters used in dataset.
-        dataset_string = ''.join(self.data)
-        self.unique_char_set = sorted(list(set(dataset_string)))
-
-        logger.info('Total Characters: {0}'.format(len(dataset_string)))
+        # Note: Built per record, to avoid holding a full concatenated copy of the dataset in memory.
+        char_set = set()
+        total_chars = 0
+        for record in self.data:
+            char_set.update(record)
+            total_chars += len(record)
+        self.unique_char_set = sorted(char_set)
+        max_code_point = ord(self.unique_char_set[-1])
+
+        logger.info('Total Characters: {0}'.format(total_chars))
         logger.info('Total Records: {0}'.format(len(self.data)))
         logger.info('Unique Char Set: {0}'.format(self.unique_char_set))
         logger.info('Unique Char Count: {0}'.format(len(self.unique_char_set)))
 
         # # Remove rarely used characters.
-        # self.remove_extra_characters(dataset_string)
+        # self.remove_extra_characters(''.join(self.data))
+
+        self.unique_char_count = len(self.unique_char_set)
 
         # Create Char to Int dictionary.
-        for enumeration, value in enumerate(self.unique_char_set):
-            self.char_to_int_dict[value] = enumeration
+        self.char_to_int_dict = {char: char_int for char_int, char in enumerate(self.unique_char_set)}
         logger.info('Char to Int Dict: {0}'.format(self.char_to_int_dict))
 
         # Create Int to Char dictionary.
-        for value, enumeration in enumerate(self.unique_char_set):
-            self.int_to_char_dict[value] = enumeration
+        self.int_to_char_dict = {char_int: char for char_int, char in enumerate(self.unique_char_set)}
         logger.info('Int to Char Dict: {0}'.format(self.int_to_char_dict))
+
+        # Create Int to Char array, for decoding full sequences of ints at once.
+        # Note: Uses object dtype, as numpy unicode arrays strip trailing nulls, which would drop the '\0' char.
+        self.int_to_char_array = numpy.array(self.unique_char_set, dtype=object)
+
+        # Create code point to Int lookup table, for bulk translation of records.
+        # Any characters not in the char set (such as removed rare characters) translate to the null pad character.
+        self.char_lookup_table = numpy.full(max_code_point + 1, self.char_to_int_dict['\0'], dtype=numpy.int32)
+        for char, char_int in self.char_to_int_dict.items():
+            self.char_lookup_table[ord(char)] = char_int
+
+        # Create Int to Onehot lookup matrix. Final row is all zeros, for use as padding.
+        self.onehot_lookup = numpy.eye(self.unique_char_count + 1, self.unique_char_count, dtype=numpy.float32)
         logger.info('')
         logger.info('')
 
@@ -165,90 +248,112 @@ class RecurrentNet():
         logger.info('Unique Char Set Before Removal: {0}'.format(self.unique_char_set))
         logger.info('Unique Char Count Before Removal: {0}'.format(len(self.unique_char_set)))
 
-        #
-        for char in self.unique_char_set:
-            # logger.info('Value: {0}'.format(char))
-            if dataset_string.count(char) < min_required_count:
-                self.unique_char_set.remove(char)
+        # Count all characters in a single pass, by code point.
+        code_points = numpy.frombuffer(dataset_string.encode('utf-32-le', errors='surrogatepass'), dtype=numpy.uint32)
+        char_counts = numpy.bincount(code_points)
+        self.unique_char_set = [
+            char for char in self.unique_char_set
+            if char_counts[ord(char)] >= min_required_count
+        ]
 
         logger.info('Unique Char Count After Removal: {0}'.format(len(self.unique_char_set)))
         logger.info('Unique Char Set After Removal: {0}'.format(self.unique_char_set))
 
-    def train(self, num_epochs=1000):
+    def prepare_tensors(self):
+        """
+        Convert dataset into feature and target ids. Only needs to run once per dataset.
+        """
+        char_count = self.unique_char_count
+        string_length = self.max_string_length
+
+        # Translate all records into padded int sequences.
+        # Targets are the feature sequence shifted left by one, with a trailing null character.
+        # Feature padding uses the index of the char count, which is out of onehot range and so becomes a zero row.
+        # Target padding uses the null character. Padded positions are masked out of the loss regardless.
+        pad_index = char_count
+        null_index = self.char_to_int_dict['\0']
+        feature_ids = numpy.full((len(self.data), string_length), pad_index, dtype=numpy.int32)
+        target_ids = numpy.full((len(self.data), string_length), null_index, dtype=numpy.int32)
+        for record_index, record in enumerate(self.data):
+            # Note: Surrogates are passed through, as lone surrogates can appear in valid JSON (such as split emoji).
+            code_points = numpy.frombuffer(record.encode('utf-32-le', errors='surrogatepass'), dtype=numpy.uint32)
+            char_ids = self.char_lookup_table[code_points]
+            feature_ids[record_index, :char_ids.size] = char_ids
+            target_ids[record_index, :(char_ids.size - 1)] = char_ids[1:]
+            target_ids[record_index, (char_ids.size - 1)] = null_index
+
+        # Features stay as int ids. Onehots are only expanded per batch during training, to keep memory use down.
+        self.feature_ids = feature_ids
+
+        # Targets stay as int ids, with a trailing axis for sparse categorical crossentropy.
+        self.targets = target_ids[..., numpy.newaxis]
+
+        # logger.info('Feature Ids:\n{0}'.format(self.feature_ids))
+        # logger.info('Target Ids:\n{0}'.format(self.targets))
+
+        # Data is already padded to max string length by the id translation above.
+        assert self.feature_ids.shape == (len(self.data), string_length)
+        assert self.targets.shape == (len(self.data), string_length, 1)
+
+    def train(self, num_epochs=1000, batch_size=None):
         """
         Train neural net on data.
+        :param num_epochs: Number of epochs to train for.
+        :param batch_size: Number of records per batch. Defaults to a tenth of the dataset, capped at 256.
         """
-        # Convert feature and target data into onehots.
-        features = numpy.zeros((len(self.data), self.max_string_length, len(self.unique_char_set)))
-        targets = numpy.zeros((len(self.data), self.max_string_length, len(self.unique_char_set)))
-        for record_index in range(len(self.data)):
-
-            # Set up feature inputs.
-            input_sequence = []
-            for char in self.data[record_index]:
-                input_sequence.append(self.char_to_int_dict[char])
-
-            features[record_index] = self.convert_to_onehot(input_sequence)
-
-            # Set up target inputs.
-            output_sequence = []
-            for char in self.data[record_index]:
-                output_sequence.append(self.char_to_int_dict[char])
-            output_sequence.pop(0)
-            output_sequence.append(self.char_to_int_dict['\0'])
-
-            targets[record_index] = self.convert_to_onehot(output_sequence)
-
-        # logger.info('Feature Onehot:\n{0}'.format(features))
-        # logger.info('Target Onehot:\n{0}'.format(targets))
-
-        # Pad data values.
-        features = keras.preprocessing.sequence.pad_sequences(features, maxlen=self.max_string_length)
-        targets = keras.preprocessing.sequence.pad_sequences(targets, maxlen=self.max_string_length)
-
-        for index in range(num_epochs):
-            logger.info('')
-            logger.info('')
-            logger.info('Epoch {0}'.format(index))
-            self.model.fit(features, targets, batch_size=self.max_string_length, verbose=1)
-            if index % 10 == 0:
-                generated_values = self.generate_text()
-                logger.testresult('Epoch: {0}   Full Generated Int String: {1}'.format(index, generated_values[0]))
-                logger.testresult('Epoch: {0}   Full Generated Char String: {1}'.format(index, generated_values[1]))
-            if index % 50 == 0:
-                self.model.save_weights(
-                    'Documents/Weights/4LSTM_Size{0}_atEpoch{1}_{2}'
-                        .format(len(self.unique_char_set), index, datetime.datetime.now().strftime('%y-%m-%d_%I:%M')))
+        if batch_size is None:
+            batch_size = min(256, max(1, len(self.data) // 10))
+        logger.info('Batch Size: {0}'.format(batch_size))
+
+        # Build input pipeline once, for all epochs.
+        # Only compact int ids are shuffled and batched. Each batch is then expanded to onehots on the fly.
+        # Padded ids equal the char count, which one_hot converts to all-zero rows, so they stay maskable.
+        char_count = self.unique_char_count
+        dataset = tensorflow.data.Dataset.from_tensor_slices((self.feature_ids, self.targets))
+        dataset = dataset.shuffle(len(self.data)).batch(batch_size)
+        dataset = dataset.map(
+            lambda feature_ids, targets: (tensorflow.one_hot(feature_ids, char_count), targets),
+            num_parallel_calls=tensorflow.data.AUTOTUNE,
+        )
+        dataset = dataset.prefetch(tensorflow.data.AUTOTUNE)
+
+        self.model.fit(
+            dataset,
+            epochs=num_epochs,
+            callbacks=[EpochCallback(self)],
+            verbose=1,
+        )
 
     def convert_to_onehot(self, sequence):
         """
         Convert sequence to onehot.
-        :param sequence: Sequence to convert.
+        Standalone helper. Not used by training, which expands batches of feature ids to onehots in its input pipeline.
+        :param sequence: Sequence of char ints to convert.
         :return: Onehot of sequence.
         """
-        new_onehot = numpy.zeros((self.max_string_length, len(self.unique_char_set)))
-        # for char_index in range(self.max_string_length):
-        for char_index in range(len(sequence)):
-            new_onehot[char_index][sequence[char_index]] = 1
-        return new_onehot
+        sequence = numpy.asarray(sequence, dtype=numpy.intp)
+
+        # Pad sequence with the zero row index, then gather all rows from the onehot lookup at once.
+        padded_sequence = numpy.full(self.max_string_length, self.unique_char_count, dtype=numpy.intp)
+        padded_sequence[:sequence.shape[0]] = sequence
+        return self.onehot_lookup[padded_sequence]
 
     def append_onehot(self, old_onehot, row_index, char):
         """
         Changes a single row of given onehot.
+        Standalone helper. Not used by training or text generation, which index the onehot lookup directly.
         :param old_onehot: Onehot to modify.
         :param row_index: Row of onehot to modify.
         :param char: New char value to set row to.
         :return: Modified onehot.
         """
-        new_row = numpy.zeros((1, len(self.unique_char_set)))
-        new_row[0][self.char_to_int_dict[char]] = 1
-
-        try:
+        # Write directly into the existing row, rather than allocating a new one.
+        # If row is past end of onehot, then should be end of string anyway.
+        if row_index < old_onehot.shape[1]:
             # logger.info('Old Row {0}: {1}'.format(row_index, old_onehot[0][row_index]))
-            old_onehot[0][row_index] = new_row
+            old_onehot[0, row_index, :] = 0
+            old_onehot[0, row_index, self.char_to_int_dict[char]] = 1
             # logger.info('New Row {0}: {1}'.format(row_index, old_onehot[0][row_index]))
-        except IndexError:
-            pass # If index error occurs, then should be end of string anyway.
         return old_onehot
 
     def generate_text(self):
@@ -257,34 +362,25 @@ class RecurrentNet():
         :return: The full generated text. Is in tuple form, with
         """
         logger.info('Attempting to generate text.')
-        generated_text = numpy.zeros((1, self.max_string_length, len(self.unique_char_set)))
-        generated_text[0] = self.append_onehot(generated_text, 0, '\1')
-        generated_char_string = ''
-        generated_int_string = ''
-        for index in range(self.max_string_length):
-            try:
-                predict_value = self.model.predict(generated_text)[0]
-                predict_value = numpy.argmax(predict_value[index])
-
-                # logger.info('Predicted Value: {0}({1})'.format(predict_value, self.int_to_char_dict[predict_value]))
-                generated_text[0] = self.append_onehot(generated_text, (index + 1), self.int_to_char_dict[predict_value])
-            except IndexError:
-                pass  # If index error occurs, then should be end of string anyway.
-
-            # Display generated string values.
-            generated_char_string = ''
-            generated_int_string = ''
-            for test_index in range(len(generated_text[0])):
-                conversion_index = None
-                for onehot_index in range(len(generated_text[0][test_index])):
-                    if generated_text[0][test_index][onehot_index] == 1:
-                        conversion_index = onehot_index
-                        break
-                try:
-                    generated_char_string += self.int_to_char_dict[conversion_index]
-                    generated_int_string += str(conversion_index) + ' '
-                except KeyError:
-                    break
+        string_length = self.max_string_length
+        predict_value = self.char_to_int_dict['\1']
+        generated_ids = [predict_value]
+
+        # Sync sampler with latest trained weights, then feed in one character at a time.
+        # Each step's input is the (1, 1, char count) onehot of the previously predicted character.
+        self.sampler.set_weights(self.model.get_weights())
+        self.sampler.reset_states()
+        for index in range(string_length - 1):
+            step_input = self.onehot_lookup[[[predict_value]]]
+            predict_value = self.sample_step(tensorflow.constant(step_input)).numpy()[0]
+            predict_value = numpy.argmax(predict_value[0])
+
+            # logger.info('Predicted Value: {0}({1})'.format(predict_value, self.int_to_char_dict[predict_value]))
+            generated_ids.append(predict_value)
+
+        # Convert generated ids to display string values.
+        generated_char_string = ''.join(self.int_to_char_array[generated_ids])
+        generated_int_string = ''.join('{0} '.format(char_int) for char_int in generated_ids)
         # logger.info('Full Generated String: {0}'.format(generated_int_string))
         # logger.info('Full Generated String: {0}'.format(generated_char_string))
         return (generated_int_string, generated_char_string)
@@ -296,3 +392,27 @@ class RecurrentNet():
         """
         self.model.load_weights(location)
         self.model.summary()
+
+
+class EpochCallback(keras.callbacks.Callback):
+    """
+    Handles periodic text generation and weight saving for Recurrent Net training.
+    """
+    def __init__(self, recurrent_net):
+        super().__init__()
+        self.recurrent_net = recurrent_net
+
+    def on_epoch_begin(self, epoch, logs=None):
+        logger.info('')
+        logger.info('')
+        logger.info('Epoch {0}'.format(epoch))
+
+    def on_epoch_end(self, epoch, logs=None):
+        if epoch % 10 == 0:
+            generated_values = self.recurrent_net.generate_text()
+            logger.testresult('Epoch: {0}   Full Generated Int String: {1}'.format(epoch, generated_values[0]))
+            logger.testresult('Epoch: {0}   Full Generated Char String: {1}'.format(epoch, generated_values[1]))
+        if epoch % 50 == 0:
+            self.model.save_weights(
+                'Documents/Weights/4LSTM_Size{0}_atEpoch{1}_{2}'
+                    .format(self.recurrent_net.unique_char_count, epoch, datetime.datetime.now().strftime('%y-%m-%d_%I:%M')))